@@ -0,0 +1,107 @@
+# the client half of git-scripts-daemon
+# every script imports this before anything else, so it must stay cheap to
+# import: anything beyond os and sys is only imported once we know the daemon
+# is enabled
+import os
+import sys
+
+
+SOCKET_NAME = 'scripts-daemon.sock'
+LOCK_NAME = 'scripts-daemon.lock'
+# the daemon handles one request at a time, and acknowledges a connection
+# with this byte once it is ready to take it
+READY = b'\0'
+# if the daemon is busy with another request for longer than this (in
+# seconds), we run the script ourselves instead of waiting
+ACCEPT_TIMEOUT = 0.1
+# set by the daemon itself, so that scripts running inside it do not try to
+# forward themselves back to it
+IN_DAEMON = False
+
+
+def socket_path(git_dir):
+    return os.path.join(git_dir, SOCKET_NAME)
+
+
+def daemon_executable():
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'git-scripts-daemon')
+
+
+def send_request(git_dir, request, fds=(), accept_timeout=None):
+    # the request is a pickled dict, prefixed by its length, and the reply is
+    # a pickled exit status
+    # fds are passed alongside the request using SCM_RIGHTS
+    # we keep our end of the connection open until the reply arrives, because
+    # the daemon stops the script as soon as we close it
+    import socket
+    import pickle
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(accept_timeout)
+        sock.connect(socket_path(git_dir))
+        # raises socket.timeout if the daemon is busy
+        if sock.recv(1) != READY:
+            # the daemon closed the connection without taking it, because it is
+            # shutting down
+            raise ConnectionRefusedError('git-scripts-daemon did not accept the connection')
+        sock.settimeout(None)
+        data = pickle.dumps(request)
+        socket.send_fds(sock, [len(data).to_bytes(8, 'big') + data], list(fds))
+        with sock.makefile('rb') as reply:
+            return pickle.load(reply)
+
+
+def start_daemon(git_dir):
+    # the daemon detaches into its own session, so it outlives this process
+    # and does not receive signals meant for our terminal
+    import subprocess
+    subprocess.Popen(
+        [sys.executable, daemon_executable(), 'serve', git_dir],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def forward(script):
+    # the daemon is opt-in, using GIT_SCRIPTS_DAEMON=1
+    if IN_DAEMON or os.environ.get('GIT_SCRIPTS_DAEMON') != '1':
+        return
+    import socket
+    import subprocess
+    # one daemon serves one repository, and its socket lives in the git dir
+    try:
+        git_dir = subprocess.run(
+            ['git', 'rev-parse', '--absolute-git-dir'],
+            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True,
+        ).stdout.strip()
+    except subprocess.CalledProcessError:
+        # not in a repository, let the script fail the usual way
+        return
+    request = {
+        'command': 'run',
+        'script': script,
+        'argv': sys.argv[1:],
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+    }
+    try:
+        # our stdin, stdout and stderr go along with the request, so the
+        # script (and every git command it runs) reads and writes them exactly
+        # as it would have if it ran in this process
+        status = send_request(git_dir, request, fds=(0, 1, 2), accept_timeout=ACCEPT_TIMEOUT)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # no daemon is running, so start one for next time, and handle this
+        # invocation ourselves
+        start_daemon(git_dir)
+        return
+    except socket.timeout:
+        # the daemon is busy with another invocation, which could take
+        # arbitrarily long (eg one waiting on its stdin), so handle this one
+        # ourselves rather than queueing up behind it
+        return
+    except EOFError:
+        # the script may have already done part of its work, so it is not
+        # safe to just run it again here
+        raise RuntimeError('git-scripts-daemon exited before {} finished'.format(script))
+    sys.exit(status)
@@ -158,6 +158,9 @@ class DiffList(list):
         next_line = next(self.stream, None)
         while next_state is not None and next_line is not None:
             next_state, next_line = next_state(next_line)
+        # the stream is only needed while parsing, and dropping it lets the
+        # parsed diff be pickled
+        del self.stream
 
     def parse_git_headers(self, line):
         # a git patch starts with "diff --git <file1> <file2>"
@@ -0,0 +1,133 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+GIT_ABSORB = os.path.join(SCRIPT_DIR, 'git-absorb')
+
+
+class GitAbsorbRepeatRunTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = self.tmp.name
+        # make sure the daemon does not get involved, and that the user's own
+        # config cannot change the results
+        self.env = dict(os.environ, HOME=self.repo, GIT_CONFIG_NOSYSTEM='1')
+        self.env.pop('GIT_SCRIPTS_DAEMON', None)
+        self.git('init', '-q', '-b', 'main')
+        self.git('config', 'user.email', 'author@example.com')
+        self.git('config', 'user.name', 'Author')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def git(self, *args):
+        subprocess.run(['git', *args], cwd=self.repo, env=self.env, check=True, stdout=subprocess.DEVNULL)
+
+    def write(self, path, lines):
+        with open(os.path.join(self.repo, path), 'w') as f:
+            f.write(''.join(map(lambda line: line + '\n', lines)))
+
+    def absorb(self):
+        return subprocess.run([GIT_ABSORB], cwd=self.repo, env=self.env, check=True, stdout=subprocess.PIPE).stdout
+
+    def absorb_fresh(self):
+        # the same run, without anything from the previous one
+        os.unlink(os.path.join(self.repo, '.git', 'absorb-cache'))
+        return self.absorb()
+
+    def commit_stack(self, paths):
+        # a base commit on main, and one commit on top of it in the stack
+        for path in paths:
+            self.write(path, ['1', '2', '3'])
+        self.git('add', '.')
+        self.git('commit', '-q', '-m', 'base')
+        self.git('checkout', '-q', '-b', 'feature')
+        for path in paths:
+            self.write(path, ['1', '2', '3', '4'])
+        self.git('commit', '-q', '-a', '-m', 'stack')
+
+    def test_repeat_run_with_quoted_paths(self):
+        # git quotes both of these paths in patch headers (the first because
+        # of core.quotePath, the second because of the tab)
+        paths = ['ñ.txt', 'tab\tname']
+        self.commit_stack(paths)
+        for path in paths:
+            self.write(path, ['one', '2', '3', '4'])
+        self.git('add', '.')
+
+        # the second run is served from the cache written by the first
+        first = self.absorb()
+        self.assertTrue(os.path.exists(os.path.join(self.repo, '.git', 'absorb-cache')))
+        self.assertEqual(first, self.absorb())
+
+    def test_corrupt_cache(self):
+        self.commit_stack(['f'])
+        self.write('f', ['one', '2', '3', '4'])
+        self.git('add', 'f')
+        fresh = self.absorb()
+        # each of these fails to unpickle with a different exception
+        for garbage in [b'I1x\n.', b'\x80\x05\x8c\x02\xff\xfe\x94.', b'(K\x01t\x94h\x05.']:
+            with open(os.path.join(self.repo, '.git', 'absorb-cache'), 'wb') as f:
+                f.write(garbage)
+            self.assertEqual(fresh, self.absorb())
+
+    def test_mode_change_without_content_change(self):
+        self.commit_stack(['f'])
+        self.write('f', ['one', '2', '3', '4'])
+        self.git('add', 'f')
+        self.absorb()
+        # the staged blob is the same as in the previous run
+        os.chmod(os.path.join(self.repo, 'f'), 0o755)
+        self.git('add', 'f')
+        cached = self.absorb()
+        self.assertIn(b"'after_mode': 'executable'", cached)
+        self.assertEqual(cached, self.absorb_fresh())
+
+    def test_partial_reuse(self):
+        self.commit_stack(['a', 'b'])
+        self.write('a', ['one', '2', '3', '4'])
+        self.write('b', ['one', '2', '3', '4'])
+        self.git('add', '.')
+        self.absorb()
+        # only b has to be diffed again
+        self.write('b', ['1', 'two', '3', '4'])
+        self.git('add', '.')
+        self.assertEqual(self.absorb(), self.absorb_fresh())
+
+    def test_rename_pairing_changes(self):
+        self.commit_stack(['p'])
+        lines = list(map(str, range(20)))
+        self.write('p', lines)
+        self.git('commit', '-q', '-a', '-m', 'longer')
+        self.git('rm', '-q', 'p')
+        self.write('q2', lines + ['y'])
+        self.git('add', '.')
+        self.absorb()
+        # p can only be renamed once, so q1 becomes a copy of it, but when q1
+        # is diffed on its own (because p -> q2 is cached), it is a rename
+        self.write('q1', lines + ['x'])
+        self.git('add', '.')
+        cached = self.absorb()
+        self.assertIn(b"'copy from'", cached)
+        self.assertEqual(cached, self.absorb_fresh())
+
+    def test_mailmap_change(self):
+        self.commit_stack(['f'])
+        # the stack was authored by someone else, but the mailmap says it was
+        # the same person all along
+        self.git('config', 'user.email', 'other@example.com')
+        self.write('.mailmap', ['<other@example.com> <author@example.com>'])
+        self.write('f', ['one', '2', '3', '4'])
+        self.git('add', 'f')
+        self.assertIn(b'other@example.com', self.absorb())
+        # until it doesn't
+        os.unlink(os.path.join(self.repo, '.mailmap'))
+        result = subprocess.run([GIT_ABSORB], cwd=self.repo, env=self.env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn(b'foreign authors', result.stderr)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, SCRIPT_DIR)
+import daemon_client
+
+
+# everything the daemon needs to run git-absorb and git-parse-patch
+SCRIPTS = ['daemon_client.py', 'utils.py', 'difflist.py', 'git-scripts-daemon', 'git-absorb', 'git-parse-patch']
+
+
+class GitScriptsDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = os.path.join(self.tmp.name, 'repo')
+        # the daemon restarts whenever its own code changes, so it runs from a
+        # copy that the tests are free to change
+        self.scripts = os.path.join(self.tmp.name, 'scripts')
+        os.mkdir(self.repo)
+        os.mkdir(self.scripts)
+        for script in SCRIPTS:
+            shutil.copy2(os.path.join(SCRIPT_DIR, script), self.scripts)
+        # every git command logs the process that started it, which tells us
+        # whether a script ran in the daemon or on its own
+        self.log = os.path.join(self.tmp.name, 'git.log')
+        shim_dir = os.path.join(self.tmp.name, 'bin')
+        os.mkdir(shim_dir)
+        with open(os.path.join(shim_dir, 'git'), 'w') as f:
+            f.write('#!/bin/sh\necho $PPID >> {}\nexec {} "$@"\n'.format(self.log, shutil.which('git')))
+        os.chmod(os.path.join(shim_dir, 'git'), 0o755)
+        # make sure the user's own config cannot change the results
+        self.env = dict(
+            os.environ,
+            HOME=self.repo,
+            GIT_CONFIG_NOSYSTEM='1',
+            PATH=os.pathsep.join([shim_dir, os.environ['PATH']]),
+        )
+        self.env.pop('GIT_SCRIPTS_DAEMON', None)
+        self.warm_env = dict(self.env, GIT_SCRIPTS_DAEMON='1')
+
+        self.git('init', '-q', '-b', 'main')
+        self.git('config', 'user.email', 'author@example.com')
+        self.git('config', 'user.name', 'Author')
+        self.write('f', ['1', '2', '3'])
+        self.git('add', 'f')
+        self.git('commit', '-q', '-m', 'base')
+        self.git('checkout', '-q', '-b', 'feature')
+        self.write('f', ['1', '2', '3', '4'])
+        self.git('commit', '-q', '-a', '-m', 'stack')
+        self.write('f', ['one', '2', '3', '4'])
+        self.git('add', 'f')
+
+        self.git_dir = os.path.join(self.repo, '.git')
+        self.daemon = subprocess.Popen(
+            [os.path.join(self.scripts, 'git-scripts-daemon'), 'serve', self.git_dir],
+            env=self.env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+        )
+        self.wait_for_daemon()
+
+    def tearDown(self):
+        # there may be a daemon that the scripts started themselves
+        try:
+            daemon_client.send_request(self.git_dir, {'command': 'stop'}, accept_timeout=5)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        self.daemon.wait(timeout=10)
+        self.tmp.cleanup()
+
+    def git(self, *args):
+        subprocess.run(['git', *args], cwd=self.repo, env=self.env, check=True, stdout=subprocess.DEVNULL)
+
+    def write(self, path, lines):
+        with open(os.path.join(self.repo, path), 'w') as f:
+            f.write(''.join(map(lambda line: line + '\n', lines)))
+
+    def wait_for_daemon(self):
+        for _ in range(100):
+            try:
+                daemon_client.send_request(self.git_dir, {'command': 'ping'}, accept_timeout=1)
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.05)
+        self.fail('daemon did not start')
+
+    def run_script(self, script, env, stdin=subprocess.DEVNULL):
+        # returns the result, and the processes that ran its git commands
+        if os.path.exists(self.log):
+            os.unlink(self.log)
+        proc = subprocess.Popen(
+            [os.path.join(self.scripts, script)],
+            cwd=self.repo,
+            env=env,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, stderr = proc.communicate(timeout=30)
+        with open(self.log) as f:
+            runners = set(map(int, f.read().split()))
+        return (proc.returncode, stdout, stderr), runners - {proc.pid}
+
+    def absorb(self):
+        result, runners = self.run_script('git-absorb', self.warm_env)
+        # the client itself only ever runs rev-parse
+        self.assertEqual(runners, {self.daemon.pid})
+        return result
+
+    def test_warm_output_matches_cold(self):
+        cold, _ = self.run_script('git-absorb', self.env)
+        self.assertEqual(cold[0], 0)
+        self.assertEqual(cold, self.absorb())
+        # the second run is served from what the first one left behind
+        self.assertEqual(cold, self.absorb())
+
+    def test_index_change(self):
+        self.absorb()
+        self.write('f', ['1', 'two', '3', '4'])
+        self.git('add', 'f')
+        cold, _ = self.run_script('git-absorb', self.env)
+        self.assertEqual(cold, self.absorb())
+
+    def test_config_change(self):
+        self.assertEqual(self.absorb()[0], 0)
+        # the stack now belongs to someone else
+        self.git('config', 'user.email', 'other@example.com')
+        cold, _ = self.run_script('git-absorb', self.env)
+        self.assertEqual(cold[0], 1)
+        self.assertIn(b'foreign authors', cold[2])
+        self.assertEqual(cold[:2], self.absorb()[:2])
+
+    def test_busy_daemon(self):
+        # git parse-patch reads its stdin until it is closed, which keeps the
+        # daemon busy until then
+        busy = subprocess.Popen(
+            [os.path.join(self.scripts, 'git-parse-patch')],
+            cwd=self.repo,
+            env=self.warm_env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            for _ in range(100):
+                try:
+                    daemon_client.send_request(self.git_dir, {'command': 'ping'}, accept_timeout=daemon_client.ACCEPT_TIMEOUT)
+                except socket.timeout:
+                    break
+                time.sleep(0.05)
+            else:
+                self.fail('daemon never got busy')
+            cold, _ = self.run_script('git-absorb', self.env)
+            start = time.monotonic()
+            result, runners = self.run_script('git-absorb', self.warm_env)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual(runners, set())
+            self.assertEqual(cold, result)
+        finally:
+            busy.stdin.close()
+            self.assertEqual(busy.wait(timeout=10), 0)
+
+    def test_code_change(self):
+        self.absorb()
+        with open(os.path.join(self.scripts, 'utils.py'), 'a') as f:
+            f.write('\n')
+        # the daemon turns this one away, so it runs on its own
+        result, runners = self.run_script('git-absorb', self.warm_env)
+        self.assertEqual(result[0], 0)
+        self.assertEqual(runners, set())
+        # and after restarting, the daemon takes requests again
+        self.wait_for_daemon()
+        result, runners = self.run_script('git-absorb', self.warm_env)
+        self.assertEqual(result[0], 0)
+        self.assertEqual(len(runners), 1)
+
+    def test_stop(self):
+        daemon_client.send_request(self.git_dir, {'command': 'stop'}, accept_timeout=5)
+        self.assertEqual(self.daemon.wait(timeout=10), 0)
+        self.assertEqual(sorted(filter(lambda name: 'scripts-daemon' in name, os.listdir(self.git_dir))), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
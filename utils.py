@@ -1,9 +1,16 @@
+import os
 import subprocess
 import urllib.parse
-import urllib.request
-import json
-import codecs
-UTF8Reader = codecs.getreader('utf-8')
+
+
+# state that is kept between invocations when a script runs inside
+# git-scripts-daemon, which replaces this with a dict (and empties it whenever
+# the repo changes)
+# outside the daemon, every invocation starts from scratch, so this is None
+WARM_STATE = None
+
+# how long to wait on a stalled https connection (in seconds) before giving up
+HTTPS_TIMEOUT = 60
 
 
 def deprefix(val, prefix, check=False):
@@ -22,10 +29,61 @@ def desuffix(val, suffix, check=False):
     return val
 
 
+def stat_stamp(path):
+    # git replaces files by renaming a lockfile over them, so a changed file
+    # always has a new inode or mtime
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
 def invoke(*cmd):
     return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
 
 
+def git_config_canonical_name(variable):
+    # the section and the key are case-insensitive, and git config --list
+    # prints them in lowercase, but the subsection (everything between the
+    # first and last dots) is case-sensitive
+    [section, *subsection, key] = variable.split('.')
+    return '.'.join([section.lower(), *subsection, key.lower()])
+
+
+def git_config_snapshot():
+    # with --show-origin and --null, every entry is preceded by its origin (eg
+    # "file:<path>" or "command line:") and a null
+    # the entry itself is the name, a newline, the value and a null
+    # if a variable has no value at all (eg "[core] bare"), then the newline
+    # is omitted too (and git config --get would print an empty string)
+    fields = invoke('git', 'config', '--list', '--show-origin', '--null').split('\0')[:-1]
+    snapshot = {}
+    # besides every file git actually read, we watch the files it would read if
+    # they existed, so that creating one also invalidates the snapshot
+    # TODO: git built with a different prefix reads $(prefix)/etc/gitconfig
+    xdg_config_home = os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config'))
+    files = {
+        os.environ.get('GIT_CONFIG_SYSTEM', '/etc/gitconfig'),
+        os.environ.get('GIT_CONFIG_GLOBAL', os.path.expanduser('~/.gitconfig')),
+        os.path.join(xdg_config_home, 'git', 'config'),
+    }
+    for origin, entry in zip(fields[0::2], fields[1::2]):
+        [name, _, value] = entry.partition('\n')
+        name = git_config_canonical_name(name)
+        snapshot.setdefault(name, []).append(value)
+        if not origin.startswith('file:'):
+            continue
+        origin_path = os.path.abspath(deprefix(origin, 'file:'))
+        files.add(origin_path)
+        # included files that do not exist (or whose includeIf condition is
+        # false) are not listed as origins, so add the include targets as
+        # well, which are relative to the file that includes them
+        if name == 'include.path' or (name.startswith('includeif.') and name.endswith('.path')):
+            files.add(os.path.join(os.path.dirname(origin_path), os.path.expanduser(value)))
+    return snapshot, list(map(lambda path: (path, stat_stamp(path)), sorted(files)))
+
+
 def git_config_get(*names, default=None, get_all=False):
     action = '--get'
     if get_all:
@@ -33,15 +91,27 @@ def git_config_get(*names, default=None, get_all=False):
         if default is None:
             default = []
 
-    for variable in names:
-        try:
-            ret = invoke('git', 'config', action, '--null', variable).split('\0')[:-1]
-            if not get_all:
-                [ret] = ret
-            return ret
-        except subprocess.CalledProcessError as e:
-            if e.returncode != 1:
-                raise
+    # inside the daemon, we list the entire config once and answer every
+    # lookup from that, instead of invoking git config for each one
+    if WARM_STATE is not None:
+        # the daemon drops the snapshot when any of config_files changes
+        if 'config' not in WARM_STATE:
+            WARM_STATE['config'], WARM_STATE['config_files'] = git_config_snapshot()
+        for variable in names:
+            values = WARM_STATE['config'].get(git_config_canonical_name(variable))
+            if values is not None:
+                # like git config --get, the last value wins
+                return list(values) if get_all else values[-1]
+    else:
+        for variable in names:
+            try:
+                ret = invoke('git', 'config', action, '--null', variable).split('\0')[:-1]
+                if not get_all:
+                    [ret] = ret
+                return ret
+            except subprocess.CalledProcessError as e:
+                if e.returncode != 1:
+                    raise
     if default is None:
         raise RuntimeError('git config did not contain any of {!r}'.format(names))
     return default
@@ -81,14 +151,66 @@ def github_from_remote_url(remote_url):
 
 
 def https_get_json(host, path='', params={}, headers={}):
+    # these are only needed by scripts that talk to github, so we don't pay for
+    # importing them anywhere else
+    import json
+    import codecs
+    import urllib.request
+    UTF8Reader = codecs.getreader('utf-8')
+    # inside the daemon, we keep one connection open per host, so that
+    # repeated invocations can skip the tcp and tls handshakes
+    # that connection goes straight to the host, so if urlopen would have gone
+    # through a proxy, we have to let it
+    if WARM_STATE is not None and ('https' not in urllib.request.getproxies() or urllib.request.proxy_bypass(host)):
+        body = https_get_keepalive(host, path, params, headers)
+        # None means we were redirected, which urlopen takes care of
+        if body is not None:
+            return json.load(UTF8Reader(body))
     with urllib.request.urlopen(urllib.request.Request(
         urllib.parse.urlunparse(('https', host, path, '', urllib.parse.urlencode(params), '')),
         method='GET',
         headers=headers,
-    )) as resp:
+    ), timeout=HTTPS_TIMEOUT) as resp:
         return json.load(UTF8Reader(resp))
 
 
+def https_get_keepalive(host, path, params, headers):
+    import http.client
+    import io
+    import urllib.error
+    connections = WARM_STATE.setdefault('https', {})
+    url = urllib.parse.urlunparse(('', '', path, '', urllib.parse.urlencode(params), ''))
+    # the server may have closed an idle connection since the last request, in
+    # which case we reconnect and try exactly once more
+    for attempt in range(2):
+        if host not in connections:
+            connections[host] = http.client.HTTPSConnection(host, timeout=HTTPS_TIMEOUT)
+        conn = connections[host]
+        try:
+            conn.request('GET', url, headers=headers)
+            resp = conn.getresponse()
+            # the body must be read completely before the connection can be
+            # reused
+            body = resp.read()
+            break
+        except Exception as e:
+            # never reuse a connection that failed partway through a request
+            conn.close()
+            del connections[host]
+            # a server closing an idle connection shows up as a connection
+            # error (including http.client.RemoteDisconnected)
+            if attempt != 0 or not isinstance(e, ConnectionError):
+                raise
+    # urlopen follows redirects (github uses them for renamed and transferred
+    # repos), and we would rather not duplicate its rules for that
+    if 300 <= resp.status < 400:
+        return None
+    # match urlopen, which raises on any error status
+    if resp.status >= 400:
+        raise urllib.error.HTTPError('https://{}{}'.format(host, url), resp.status, resp.reason, resp.headers, io.BytesIO(body))
+    return io.BytesIO(body)
+
+
 def get_remote_or_github_default(remote_name, headers, owner_repo=None, default=None):
     try:
         # try to resolve the remote's HEAD first